@@ -1,14 +1,31 @@
+import argparse
+import base64
+import collections
+import contextlib
+import cProfile
 import datetime
-import io
+import glob
+import hashlib
 import json
 import logging
+import os
+import pstats
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import weakref
 import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import coloredlogs
+import lxml.html
 import numpy as np
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
 from pdfquery import PDFQuery
 from pdfquery.cache import FileCache
 
@@ -57,6 +74,492 @@ URL_EXPECTED_PBI = (
 URL_MONETARY_POLICIE_RATE = f"{URL_BCRP_STATISTICS}/api/PD12301MD/json"
 URL_PERUVIAN_GOVERMENT_BOND = f"{URL_BCRP_STATISTICS}/api/PD31896MM/json"
 
+PARAMETERS_SHEET_NAME = "Parametros"
+DERIVED_SHEET_NAME = "Derived KPIs"
+OUTPUT_SUFFIX = "_output.xlsx"
+
+MONTH_INDEX = {
+    "Enero": 1,
+    "Febrero": 2,
+    "Marzo": 3,
+    "Abril": 4,
+    "Mayo": 5,
+    "Junio": 6,
+    "Julio": 7,
+    "Agosto": 8,
+    "Septiembre": 9,
+    "Octubre": 10,
+    "Noviembre": 11,
+    "Diciembre": 12,
+}
+
+# Lower case month names and abbreviations used in period labels, e.g. BCRP
+# returns "Jul.2023" for monthly series and "20.Jun.23" for daily series.
+MONTH_NUMBERS = {
+    **{name.lower(): number for name, number in MONTH_INDEX.items()},
+    **{name[:3].lower(): number for name, number in MONTH_INDEX.items()},
+    "setiembre": 9,
+    "set": 9,
+}
+
+PERIOD_LABEL_PATTERNS = [
+    r"^(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})$",
+    r"^(?P<year>\d{4})-(?P<month>\d{1,2})$",
+    r"^(?P<month>[A-Za-z]{3})\.(?P<year>\d{4})$",
+    r"^(?P<day>\d{1,2})\.(?P<month>[A-Za-z]{3})\.(?P<year>\d{2})$",
+    r"^(?P<year>\d{4})-(?P<month>[^\W\d_]+)$",
+    r"^T(?P<quarter>[1-4])\.(?P<year>\d{2}|\d{4})$",
+    r"^(?P<year>\d{4})-?Q(?P<quarter>[1-4])$",
+    r"^(?P<year>\d{4})$",
+]
+
+# Target frequencies of the resampling engine and how their periods are
+# labelled in the output sheets.
+FREQUENCY_FORMATS = {
+    "D": "%Y-%m-%d",
+    "M": "%Y-%m",
+    "Q": "%Y-Q%q",
+    "Y": "%Y",
+}
+AGGREGATIONS = ["last", "first", "mean", "sum", "end"]
+
+# Calls below this many microseconds are pruned from the folded stacks
+FOLDED_STACK_MIN_US = 1
+FOLDED_STACK_MAX_DEPTH = 128
+
+CACHE_DIR = ".kpis_cache"
+PARSED_CACHE_DIR = os.path.join(CACHE_DIR, "parsed")
+# Bump when a parse_* function changes, so payloads parsed by its previous
+# version are parsed again.
+PARSED_CACHE_VERSION = 1
+STATE_FILE = os.path.join(CACHE_DIR, "state.json")
+SP_BVL_LEVELS_FILE = os.path.join(CACHE_DIR, "sp_bvl_levels.npz")
+
+# BTG rate id and divisor of the KPIs read from BTG: 5 and 10 Years Treasury
+# Bill rates and the Dow Jones index. The ones requested by the fetch plan
+# for the same window are fetched together.
+BTG_INSTRUMENTS = {
+    16: ("UlRFLlVTVFI1WS5JU0YuRk0", 100),
+    17: ("UlRFLlVTVFIxMFkuSVNGLkZN", 100),
+    24: ("SU5ELkRPV0pPTkVTLklORkJPTA", 1),
+}
+ML_PLANNED_INSTRUMENTS = {}
+ML_DAILY_CACHE = {}
+ML_RATES_CACHE = {}
+ML_CACHE_LOCK = threading.Lock()
+
+# Set while a KPI fetch is profiled. cProfile only records the thread it was
+# enabled in, so fetches that use their own threads run inline meanwhile.
+PROFILING = threading.Event()
+
+# Counters of the current run, logged by log_run_report
+RUN_STATS = collections.Counter()
+RUN_STATS_LOCK = threading.Lock()
+PARSED_CACHE_USED = set()
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+HTML_CHUNK_SIZE = 64 * 1024
+
+ASPNET_HIDDEN_FIELDS = [
+    "__VIEWSTATE",
+    "__VIEWSTATEGENERATOR",
+    "__EVENTVALIDATION",
+]
+# ASP.NET sessions expire after 20 minutes of inactivity by default
+ASPNET_TOKENS_TTL = datetime.timedelta(minutes=15)
+ASPNET_VALIDATION_ERRORS = [
+    "Invalid postback or callback argument",
+    "Validation of viewstate MAC failed",
+    "The state information is invalid",
+]
+
+# One session for every plain GET so that connections to the same hosts are
+# reused across KPIs and across workbooks in a batch run.
+SESSION = requests.Session()
+
+
+def count_run_stat(name: str):
+    with RUN_STATS_LOCK:
+        RUN_STATS[name] += 1
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share the call of the first one:
+    # the others wait for it and get its result or its exception.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, stat: str):
+        # stat names the RUN_STATS counter of the calls that were shared
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+
+        if not leader:
+            count_run_stat(stat)
+            return future.result()
+
+        try:
+            future.set_result(function())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+        return future.result()
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+
+def get_request_key(
+    method: str, url: str, params: dict = None, data: dict = None
+) -> tuple:
+    # Requests differing only in query parameter order, host case or the
+    # way the parameters were passed map to the same key.
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    query += [(str(name), str(value)) for name, value in (params or {}).items()]
+    body = [(str(name), str(value)) for name, value in (data or {}).items()]
+
+    return (
+        method.upper(),
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path,
+        tuple(sorted(query)),
+        tuple(sorted(body)),
+    )
+
+
+def http_get(url: str, params: dict = None, **kwargs) -> requests.Response:
+    def get():
+        response = SESSION.get(url, params=params, **kwargs)
+        # Read the body now, so every caller sharing the response reuses it
+        response.content
+        return response
+
+    return SINGLE_FLIGHT.do(
+        get_request_key("GET", url, params), get, "requests_shared"
+    )
+
+
+class FormSessionPool:
+    # Keeps one warm session per ASP.NET page together with the hidden form
+    # tokens scraped from it, so repeated queries only pay for the POST. The
+    # tokens are primed again once they expire or the server rejects them.
+
+    def __init__(self, tokens_ttl: datetime.timedelta = ASPNET_TOKENS_TTL):
+        self.tokens_ttl = tokens_ttl
+        self.sessions = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, url: str) -> requests.Session:
+        with self.lock:
+            if url not in self.sessions:
+                session = requests.Session()
+                session.headers.update({"user-agent": USER_AGENT})
+                self.sessions[url] = session
+            return self.sessions[url]
+
+    def prime(self, url: str) -> dict:
+        return SINGLE_FLIGHT.do(
+            ("PRIME", url), lambda: self.prime_tokens(url), "primes_shared"
+        )
+
+    def prime_tokens(self, url: str) -> dict:
+        response = self.get_session(url).get(url)
+        tokens = extract_form_tokens(response.content)
+        missing_fields = set(ASPNET_HIDDEN_FIELDS) - tokens.keys()
+        if missing_fields:
+            raise ValueError(f"Missing form fields {missing_fields} in {url}")
+
+        self.tokens[url] = (datetime.datetime.now(), tokens)
+        return tokens
+
+    def get_tokens(self, url: str) -> dict:
+        primed_at, tokens = self.tokens.get(url, (None, None))
+        if primed_at is None or (
+            datetime.datetime.now() - primed_at > self.tokens_ttl
+        ):
+            return self.prime(url)
+        return tokens
+
+    def post(self, url: str, data: dict) -> requests.Response:
+        return SINGLE_FLIGHT.do(
+            get_request_key("POST", url, data=data),
+            lambda: self.post_form(url, data),
+            "requests_shared",
+        )
+
+    def post_form(self, url: str, data: dict) -> requests.Response:
+        session = self.get_session(url)
+        response = session.post(url, data={**self.get_tokens(url), **data})
+        if self.is_rejected(response):
+            logging.info(f"Form tokens rejected, priming again {url}")
+            response = session.post(url, data={**self.prime(url), **data})
+        return response
+
+    def is_rejected(self, response: requests.Response) -> bool:
+        return response.status_code >= 500 or any(
+            error in response.text for error in ASPNET_VALIDATION_ERRORS
+        )
+
+
+FORM_SESSIONS = FormSessionPool()
+
+
+def get_payload_digest(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+
+def parse_payload(
+    payload, parse, *args, source: str, payload_digest: str = None
+) -> pd.DataFrame:
+    # Every source, the URL the payload came from parsed by a parser with
+    # its arguments, keeps the result of its last parse with the digest of
+    # that payload. A payload identical to the last one reuses the result
+    # instead of being parsed again. Streamed downloads pass their file and
+    # the digest computed while downloading.
+    if payload_digest is None:
+        payload_digest = get_payload_digest(payload)
+    key = json.dumps([source, parse.__name__, args], default=str)
+    cache_path = os.path.join(
+        PARSED_CACHE_DIR, f"{get_payload_digest(key.encode())}.pkl"
+    )
+    PARSED_CACHE_USED.add(cache_path)
+    # Callers parsing the same payload at the same time share one parse,
+    # each of them gets its own copy of the result to modify.
+    df = SINGLE_FLIGHT.do(
+        ("PARSE", cache_path, payload_digest),
+        lambda: load_or_parse_payload(
+            cache_path, payload_digest, payload, parse, *args
+        ),
+        "parses_shared",
+    )
+    return df.copy()
+
+
+def load_or_parse_payload(
+    cache_path: str, payload_digest: str, payload, parse, *args
+) -> pd.DataFrame:
+    if os.path.exists(cache_path):
+        try:
+            cached = pd.read_pickle(cache_path)
+            if (
+                cached["version"] == PARSED_CACHE_VERSION
+                and cached["digest"] == payload_digest
+            ):
+                count_run_stat("parse_skipped")
+                return cached["df"]
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable cache {cache_path}: {e}")
+
+    df = parse(payload, *args)
+    count_run_stat("parsed")
+    cached = {
+        "version": PARSED_CACHE_VERSION,
+        "digest": payload_digest,
+        "df": df,
+    }
+    try:
+        os.makedirs(PARSED_CACHE_DIR, exist_ok=True)
+        file_descriptor, temp_file_name = tempfile.mkstemp(
+            dir=PARSED_CACHE_DIR, suffix=".tmp"
+        )
+        try:
+            with os.fdopen(file_descriptor, "wb") as cache_file:
+                pd.to_pickle(cached, cache_file)
+            os.replace(temp_file_name, cache_path)
+        except BaseException:
+            os.remove(temp_file_name)
+            raise
+    except Exception as e:
+        logging.warning(f"Error caching parsed payload {cache_path}: {e}")
+
+    return df
+
+
+def prune_parsed_cache():
+    # Parses of sources the last run did not read are dropped, so the cache
+    # holds at most one result per source of the last run.
+    for cache_path in glob.glob(os.path.join(PARSED_CACHE_DIR, "*.pkl")):
+        if cache_path not in PARSED_CACHE_USED:
+            try:
+                os.remove(cache_path)
+            except OSError as e:
+                logging.warning(f"Error removing {cache_path}: {e}")
+
+
+class SharedDownload:
+    # A downloaded file shared by every caller of the same request while it
+    # was in flight, removed once the last of them drops its reference.
+
+    def __init__(self, path: str, digest: str):
+        self.path = path
+        self.digest = digest
+        weakref.finalize(self, os.remove, path)
+
+
+@contextlib.contextmanager
+def stream_download(url: str, **kwargs):
+    # Yields a file handle on the downloaded content together with its
+    # sha256. Identical concurrent downloads share one network transfer.
+    download = SINGLE_FLIGHT.do(
+        get_request_key("GET", url, kwargs.get("params")),
+        lambda: download_to_file(url, **kwargs),
+        "requests_shared",
+    )
+    with open(download.path, "rb") as download_file:
+        yield download_file, download.digest
+
+
+def download_to_file(url: str, **kwargs) -> SharedDownload:
+    # Streams the response in chunks into a temporary file, so memory stays
+    # flat however large the file is.
+    digest = hashlib.sha256()
+    size = 0
+    file_descriptor, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(file_descriptor, "wb") as download_file:
+            with SESSION.get(url, stream=True, **kwargs) as response:
+                response.raise_for_status()
+                md5 = (
+                    hashlib.md5()
+                    if response.headers.get("Content-MD5")
+                    else None
+                )
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    download_file.write(chunk)
+                    digest.update(chunk)
+                    if md5:
+                        md5.update(chunk)
+                    size += len(chunk)
+                verify_download(response, size, md5)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    logging.debug(f"Downloaded {size} bytes from {url}")
+    return SharedDownload(path, digest.hexdigest())
+
+
+def verify_download(response: requests.Response, size: int, md5):
+    # Size and checksum headers describe the body as sent, so they can only
+    # be compared when requests did not decompress it while streaming.
+    if response.headers.get("Content-Encoding"):
+        return
+
+    content_length = response.headers.get("Content-Length")
+    if content_length and int(content_length) != size:
+        raise IOError(
+            f"Incomplete download of {response.url}: {size} of"
+            f" {content_length} bytes"
+        )
+
+    content_md5 = response.headers.get("Content-MD5")
+    if md5 and base64.b64encode(md5.digest()).decode() != content_md5:
+        raise IOError(f"Checksum mismatch downloading {response.url}")
+
+
+def iter_html_elements(content: bytes, tag: str = None, events=("end",)):
+    # Feeds the page in chunks to libxml2's pull parser and yields the
+    # elements as soon as they are parsed, so a caller that found what it
+    # needs stops before the rest of the page is parsed. Attributes are
+    # complete on "start" events, text and children on "end" events.
+    parser = etree.HTMLPullParser(events=events, tag=tag)
+    for start in range(0, len(content), HTML_CHUNK_SIZE):
+        parser.feed(content[start : start + HTML_CHUNK_SIZE])
+        for _, element in parser.read_events():
+            yield element
+
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        # Raised for pages without any element, like an empty body, where
+        # there is simply nothing to find.
+        return
+    for _, element in parser.read_events():
+        yield element
+
+
+def find_html_element(content: bytes, match, tag: str = None, events=("end",)):
+    for element in iter_html_elements(content, tag, events):
+        if match(element):
+            return element
+    return None
+
+
+def extract_form_tokens(content: bytes) -> dict:
+    tokens = {}
+    for element in iter_html_elements(content, "input", ("start",)):
+        if element.get("id") in ASPNET_HIDDEN_FIELDS:
+            tokens[element.get("id")] = element.get("value", "")
+            if len(tokens) == len(ASPNET_HIDDEN_FIELDS):
+                break
+    return tokens
+
+
+def extract_vehicular_flow_path(content: bytes) -> str:
+    row1 = find_html_element(
+        content, lambda element: element.get("id") == "row_1", events=("start",)
+    )
+    return row1.get("rel")
+
+
+def extract_pbi_data_url(content: bytes) -> str:
+    def is_download_button(element):
+        parent = element.getparent()
+        return (
+            "js-btn-download-report" in element.get("class", "").split()
+            and parent is not None
+            and parent.get("id") == "download-resumen_5-mensual-report"
+        )
+
+    button = find_html_element(content, is_download_button, events=("start",))
+    return button.get("data-url")
+
+
+def extract_price_index_path(content: bytes) -> str:
+    anchor = find_html_element(
+        content,
+        lambda element: element.get("title") == "IPC Nacional",
+        "a",
+        ("start",),
+    )
+    return anchor.get("href")
+
+
+def extract_dolar_exchange_values(content: bytes, month: str) -> dict:
+    return {
+        element.get("id"): "".join(element.itertext()).strip()
+        for element in iter_html_elements(content)
+        if element.get("id", "").startswith("gr_ctl")
+        and element.get("id").endswith(f"_{month}")
+    }
+
+
+def extract_sbs_exchange_rate(content: bytes) -> str:
+    row = find_html_element(
+        content,
+        lambda element: (
+            element.get("id") == "ctl00_cphContent_rgTipoCambio_ctl00__0"
+        ),
+        "tr",
+    )
+    if row is None:
+        return ""
+
+    cells = row.xpath("*[3][self::td]")
+    return "".join(cells[0].itertext()).strip() if cells else ""
+
 
 def get_electricity(start_date: str, end_date: str) -> pd.DataFrame:
     logging.info("Getting Electricity(GWH)")
@@ -71,71 +574,85 @@ def get_electricity(start_date: str, end_date: str) -> pd.DataFrame:
 def get_vehicular_flow(year: str) -> pd.DataFrame:
     logging.info("Getting Vehicular Flow")
     logging.info("========================")
-    pdf_file_name = "temp_vehicular_flow.pdf"
-
-    response = requests.get(f"{URL_BASE_TOLL}/{year}/1", verify=False)
-    soup = BeautifulSoup(response.text, "html.parser")
-    row1 = soup.find(id="row_1")
-
-    pdf_link = f"{URL_BASE_INEI}{row1.get('rel')}"
-    response = requests.get(pdf_link, verify=False)
-
-    with open(pdf_file_name, "wb") as pdf_file:
-        pdf_file.write(response.content)
-        pdf = PDFQuery(pdf_file_name, parse_tree_cacher=FileCache("."))
-        pdf.load()
-        # pdf.tree.write('temp_vehicular_flow.xml', pretty_print=True)
-
-        lttext_months = pdf.tree.xpath(
-            '//LTPage[@pageid="13"]/LTRect/LTTextLineVertical/LTTextBoxVertical'
-        )  # [@y0="758.48"]')
-        max_y0 = 0.0
-        month = ""
-        for i in lttext_months:
-            y0 = float(i.get("y0"))
-            if y0 > max_y0:
-                y0 = max_y0
-                month = i.text
-
-        lttext_amounts = pdf.tree.xpath(
-            '//LTPage[@pageid="13"]/LTTextLineVertical/LTTextBoxVertical'
-        )  # [@y0="743.368"]')
-        min_dist = float("inf")
-        amount = ""
-        for i in lttext_amounts:
-            y0 = float(i.get("y0"))
-            x0 = float(i.get("x0"))
-            dist = (900 - y0) + x0
-            if dist < min_dist:
-                min_dist = dist
-                amount = i.text
-        amount_value = int(amount[max(len(amount) - 11, 0) :].replace(" ", ""))
-
-        logging.info("Got Vehicular Flow")
-        date = f"{year}-{month}"
-        logging.debug(date)
-        df = pd.DataFrame(
-            {"Period": [date], "Value": [amount_value]}
-        ).set_index("Period")
-        logging.debug(df)
-        return df
+    response = http_get(f"{URL_BASE_TOLL}/{year}/1", verify=False)
+
+    pdf_link = f"{URL_BASE_INEI}{extract_vehicular_flow_path(response.content)}"
+    with stream_download(pdf_link, verify=False) as (pdf_file, digest):
+        df = parse_payload(
+            pdf_file,
+            parse_vehicular_flow_pdf,
+            year,
+            source=pdf_link,
+            payload_digest=digest,
+        )
+    logging.info("Got Vehicular Flow")
+    logging.debug(df)
+    return df
+
+
+def parse_vehicular_flow_pdf(pdf_file, year: str) -> pd.DataFrame:
+    pdf = PDFQuery(pdf_file, parse_tree_cacher=FileCache("."))
+    pdf.load()
+    # pdf.tree.write('temp_vehicular_flow.xml', pretty_print=True)
+
+    lttext_months = pdf.tree.xpath(
+        '//LTPage[@pageid="13"]/LTRect/LTTextLineVertical/LTTextBoxVertical'
+    )  # [@y0="758.48"]')
+    max_y0 = 0.0
+    month = ""
+    for i in lttext_months:
+        y0 = float(i.get("y0"))
+        if y0 > max_y0:
+            y0 = max_y0
+            month = i.text
+
+    lttext_amounts = pdf.tree.xpath(
+        '//LTPage[@pageid="13"]/LTTextLineVertical/LTTextBoxVertical'
+    )  # [@y0="743.368"]')
+    min_dist = float("inf")
+    amount = ""
+    for i in lttext_amounts:
+        y0 = float(i.get("y0"))
+        x0 = float(i.get("x0"))
+        dist = (900 - y0) + x0
+        if dist < min_dist:
+            min_dist = dist
+            amount = i.text
+    amount_value = int(amount[max(len(amount) - 11, 0) :].replace(" ", ""))
+
+    date = f"{year}-{month}"
+    logging.debug(date)
+    df = pd.DataFrame(
+        {"Period": [date], "Value": [amount_value]}
+    ).set_index("Period")
+    return df
 
 
 def get_pbi(start_date: str, end_date: str) -> pd.DataFrame:
     logging.info("Getting PBI")
     logging.info("========================")
-    response = requests.get(URL_INEI_PBI, verify=False)
-    soup = BeautifulSoup(response.text, "html.parser")
-    button = soup.select(
-        "#download-resumen_5-mensual-report > .js-btn-download-report"
-    )[0]
-    logging.debug(button)
-    data_url = button.get("data-url")
+    response = http_get(URL_INEI_PBI, verify=False)
+    data_url = extract_pbi_data_url(response.content)
+    logging.debug(data_url)
     data_url = json.loads(data_url)
     link = data_url.get("excel")
-    file_content = requests.get(link, verify=False).content
+    with stream_download(link, verify=False) as (pbi_file, digest):
+        df = parse_payload(
+            pbi_file,
+            parse_pbi_archive,
+            start_date,
+            end_date,
+            source=link,
+            payload_digest=digest,
+        )
+    logging.debug(df)
+    logging.info("Got PBI")
+
+    return df
+
 
-    with zipfile.ZipFile(io.BytesIO(file_content)) as archive:
+def parse_pbi_archive(pbi_file, start_date: str, end_date: str) -> pd.DataFrame:
+    with zipfile.ZipFile(pbi_file) as archive:
         logging.debug(archive.namelist())
 
         pbi_file_name = [
@@ -155,9 +672,6 @@ def get_pbi(start_date: str, end_date: str) -> pd.DataFrame:
             df["Año y Mes"] = df["Año y Mes"].dt.strftime("%Y-%m")
             df.set_index("Año y Mes", inplace=True)
 
-            logging.debug(df)
-            logging.info("Got PBI")
-
             return df
 
 
@@ -176,25 +690,42 @@ def get_intern_demand(start_date: str, end_date: str) -> pd.DataFrame:
 def get_price_index(year: int, month: str) -> pd.DataFrame:
     logging.info("Getting Price Index")
     logging.info("========================")
-    response = requests.get(URL_INEI_PRICE_INDEX, verify=False)
-    soup = BeautifulSoup(response.text, "html.parser")
-    anchor = soup.select("a[title='IPC Nacional']")[0]
-    link = f"{URL_BASE_INEI}{anchor.get('href')}"
-    file_content = requests.get(link, verify=False).content
-    df = pd.read_excel(io.BytesIO(file_content), skiprows=3)
-    df = df.fillna(method="ffill")
-    df["Año"] = df["Año"].astype(int)
-    df = df[(df["Año"] == int(year)) & (df["Mes"] == month)]
+    response = http_get(URL_INEI_PRICE_INDEX, verify=False)
+    link = f"{URL_BASE_INEI}{extract_price_index_path(response.content)}"
+    with stream_download(link, verify=False) as (price_index_file, digest):
+        df = parse_payload(
+            price_index_file,
+            parse_price_index_workbook,
+            year,
+            month,
+            source=link,
+            payload_digest=digest,
+        )
     logging.debug(df)
     logging.info("Got Price Index")
 
     return df
 
 
+def parse_price_index_workbook(
+    price_index_file, year: int, month: str
+) -> pd.DataFrame:
+    df = pd.read_excel(price_index_file, skiprows=3)
+    df = df.fillna(method="ffill")
+    df["Año"] = df["Año"].astype(int)
+    return df[(df["Año"] == int(year)) & (df["Mes"] == month)]
+
+
 def get_bcrp_data(start_date: str, end_date: str, url: str) -> pd.DataFrame:
-    response = requests.get(f"{url}/{start_date}/{end_date}")
-    logging.debug(f"response: {response.json()}")
-    json_response = response.json()
+    response = http_get(f"{url}/{start_date}/{end_date}")
+    return parse_payload(
+        response.content, parse_bcrp_periods, source=response.url
+    )
+
+
+def parse_bcrp_periods(content: bytes) -> pd.DataFrame:
+    json_response = json.loads(content)
+    logging.debug(f"response: {json_response}")
 
     data = json_response["periods"]
 
@@ -216,38 +747,58 @@ def format_values_per_month(
     index_date_name: str,
     divisor=1,
 ):
-    last_days_dict = {}
-    rates_dict = {}
-    start_date = datetime.datetime.strptime(start_date_str, "%Y-%m-%d")
-    end_date = datetime.datetime.strptime(end_date_str, "%Y-%m-%d")
-
-    for value in data:
-        date = pd.to_datetime(value[index_date_name], utc=True, unit="ms")
+    df = pd.DataFrame(list(data), columns=[index_date_name, index_value_name])
+    df = pd.DataFrame(
+        {
+            "group": 0,
+            "x": df[index_date_name],
+            "y": df[index_value_name] / divisor,
+        }
+    )
 
-        if date.date() < start_date.date():
-            continue
+    df = format_grouped_values_per_month(df, start_date_str, end_date_str)
+    return df.drop(columns=["group"]).reset_index(drop=True)
 
-        if date.date() > end_date.date():
-            continue
 
-        rate = value[index_value_name]
-        year_month = f"{date.year}-{date.month}"
-        if year_month in last_days_dict:
-            if date.day > last_days_dict[year_month]:
-                last_days_dict[year_month] = date.day
-                rates_dict[year_month] = rate / divisor
-        else:
-            last_days_dict[year_month] = date.day
-            rates_dict[year_month] = rate / divisor
+def format_grouped_values_per_month(
+    df: pd.DataFrame, start_date_str: str, end_date_str: str
+) -> pd.DataFrame:
+    # df holds "group", "x" (epoch milliseconds) and "y" columns; returns the
+    # last day of each month per group as "group", "date" and "rate".
+    days = (
+        pd.to_datetime(df["x"], utc=True, unit="ms")
+        .dt.tz_localize(None)
+        .dt.normalize()
+    )
+    in_range = (days >= pd.Timestamp(start_date_str)) & (
+        days <= pd.Timestamp(end_date_str)
+    )
+    df = pd.DataFrame(
+        {
+            "group": df.loc[in_range, "group"],
+            "day": days[in_range],
+            "rate": df.loc[in_range, "y"],
+        }
+    )
 
-    date_list = []
-    for key in last_days_dict:
-        date_list.append(f"{key}-{last_days_dict[key]}")
+    # First row holding the latest day of each month, in order of appearance
+    months = df["day"].dt.to_period("M")
+    df = df.loc[df.groupby([df["group"], months], sort=False)["day"].idxmax()]
+    dates = (
+        df["day"].dt.year.astype(str)
+        + "-"
+        + df["day"].dt.month.astype(str)
+        + "-"
+        + df["day"].dt.day.astype(str)
+    )
 
-    df = pd.DataFrame(
-        zip(date_list, rates_dict.values()), columns=["date", "rate"]
+    return pd.DataFrame(
+        {
+            "group": df["group"].to_numpy(),
+            "date": dates.to_numpy(),
+            "rate": df["rate"].to_numpy(),
+        }
     )
-    return df
 
 
 def get_unemployment_rate(start_date: str, end_date: str) -> pd.DataFrame:
@@ -268,14 +819,11 @@ def get_next_year_month(year: int, month: int):
 
 
 def get_month_1st(start_date: str):
-    return f"{start_date}-01"
+    return pd.Period(start_date, freq="M").start_time.strftime("%Y-%m-%d")
 
 
 def get_month_last(start_date: str):
-    next_year, next_month = get_next_year_month(int(start_date[0:4]), int(start_date[5:7]))
-    date_time = datetime.date(
-        next_year, next_month, 1
-    ) - datetime.timedelta(days=1)
+    date_time = pd.Period(start_date, freq="M").end_time.date()
     current_time = datetime.datetime.now().date()
     if current_time < date_time:
         date_time = current_time
@@ -285,21 +833,153 @@ def get_month_last(start_date: str):
 def get_ml_rate(
     rate_id: str, start_date: str, end_date: str, divisor=100
 ) -> pd.DataFrame:
+    if PROFILING.is_set():
+        # A profiled KPI fetches its own instrument only, without the rates
+        # cache, so its profile does not carry the work of other KPIs.
+        rate = fetch_ml_rates(
+            {rate_id: divisor},
+            get_month_1st(start_date),
+            get_month_last(end_date),
+        )[rate_id]
+    else:
+        instruments = ML_PLANNED_INSTRUMENTS.get((start_date, end_date), {})
+        instruments = {**instruments, rate_id: divisor}
+        rate = get_ml_rates(instruments, start_date, end_date)[rate_id]
+    if isinstance(rate, Exception):
+        raise rate
+
+    return rate
+
+
+def plan_ml_instruments(plan: dict):
+    ML_PLANNED_INSTRUMENTS.clear()
+    for kpi_id, start, end in plan:
+        if kpi_id in BTG_INSTRUMENTS:
+            rate_id, divisor = BTG_INSTRUMENTS[kpi_id]
+            instruments = ML_PLANNED_INSTRUMENTS.setdefault((start, end), {})
+            instruments[rate_id] = divisor
+
+
+def get_ml_rates(instruments: dict, start_date: str, end_date: str) -> dict:
+    # instruments maps BTG rate ids to their divisors. The daily series of
+    # every instrument is fetched concurrently and cached, then all of them
+    # are reduced to month end values in one grouped step. An instrument
+    # that could not be fetched maps to its error. KPIs asking for the same
+    # instruments at the same time share one batch, and each of them gets
+    # its own copy of the rates.
     start_date = get_month_1st(start_date)
     end_date = get_month_last(end_date)
 
+    cache_key = (tuple(sorted(instruments.items())), start_date, end_date)
+    rates = SINGLE_FLIGHT.do(
+        ("ML_RATES", cache_key),
+        lambda: load_or_fetch_ml_rates(
+            cache_key, instruments, start_date, end_date
+        ),
+        "requests_shared",
+    )
+
+    return {
+        rate_id: rate if isinstance(rate, Exception) else rate.copy()
+        for rate_id, rate in rates.items()
+    }
+
+
+def load_or_fetch_ml_rates(
+    cache_key: tuple, instruments: dict, start_date: str, end_date: str
+) -> dict:
+    with ML_CACHE_LOCK:
+        if cache_key in ML_RATES_CACHE:
+            return ML_RATES_CACHE[cache_key]
+
+    rates = fetch_ml_rates(instruments, start_date, end_date)
+    with ML_CACHE_LOCK:
+        ML_RATES_CACHE[cache_key] = rates
+
+    return rates
+
+
+def fetch_ml_rates(instruments: dict, start_date: str, end_date: str) -> dict:
+    daily_dfs = get_ml_daily_series(list(instruments), start_date, end_date)
+    rates = {
+        rate_id: daily_df
+        for rate_id, daily_df in daily_dfs.items()
+        if isinstance(daily_df, Exception)
+    }
+    fetched = [rate_id for rate_id in instruments if rate_id not in rates]
+    if fetched:
+        df = pd.concat(
+            [daily_dfs[rate_id].assign(group=rate_id) for rate_id in fetched],
+            ignore_index=True,
+        )
+        df["y"] = df["y"] / df["group"].map(instruments)
+        df = format_grouped_values_per_month(df, start_date, end_date)
+
+    for rate_id in fetched:
+        rates[rate_id] = df.loc[df["group"] == rate_id, ["date", "rate"]]
+        rates[rate_id] = rates[rate_id].reset_index(drop=True)
+
+    return rates
+
+
+def get_ml_daily_series(rate_ids: list, start_date: str, end_date: str) -> dict:
+    # A failing series only fails the KPIs reading it: its error is returned
+    # in place of the series and it is not cached.
+    def fetch(rate_id):
+        try:
+            return SINGLE_FLIGHT.do(
+                ("ML_DAILY", rate_id, start_date, end_date),
+                lambda: load_or_fetch_ml_daily_series(
+                    rate_id, start_date, end_date
+                ),
+                "requests_shared",
+            )
+        except Exception as e:
+            logging.error(f"Error fetching BTG instrument {rate_id}: {e}")
+            return e
+
+    if PROFILING.is_set() or len(rate_ids) < 2:
+        daily_dfs = list(map(fetch, rate_ids))
+    else:
+        with ThreadPoolExecutor(max_workers=len(rate_ids)) as executor:
+            daily_dfs = list(executor.map(fetch, rate_ids))
+
+    return dict(zip(rate_ids, daily_dfs))
+
+
+def load_or_fetch_ml_daily_series(
+    rate_id: str, start_date: str, end_date: str
+) -> pd.DataFrame:
+    cache_key = (rate_id, start_date, end_date)
+    with ML_CACHE_LOCK:
+        if cache_key in ML_DAILY_CACHE:
+            return ML_DAILY_CACHE[cache_key]
+
+    daily_df = fetch_ml_daily_series(rate_id, start_date, end_date)
+    with ML_CACHE_LOCK:
+        ML_DAILY_CACHE[cache_key] = daily_df
+
+    return daily_df
+
+
+def fetch_ml_daily_series(
+    rate_id: str, start_date: str, end_date: str
+) -> pd.DataFrame:
     url = f"{URL_BASE_ML}{rate_id}/historicalData"
     params = {
         "dateStart": start_date,
         "dateEnd": end_date,
     }
     headers = {"User-Agent": USER_AGENT}
-    response = requests.get(url, params=params, headers=headers, verify=False)
-    jsonResponse = response.json()
+    response = http_get(url, params=params, headers=headers, verify=False)
+
+    return parse_payload(response.content, parse_ml_chart, source=response.url)
 
-    return format_values_per_month(
-        jsonResponse["chart"], start_date, end_date, "y", "x", divisor
-    )
+
+def parse_ml_chart(content: bytes) -> pd.DataFrame:
+    jsonResponse = json.loads(content)
+
+    return pd.DataFrame(jsonResponse["chart"], columns=["x", "y"])
 
 
 def get_5years_treasury_bill_rate(
@@ -346,27 +1026,88 @@ def get_sp_bvl_general_index(start_date: str, end_date: str) -> pd.DataFrame:
     start_date = get_month_1st(start_date)
     end_date = get_month_last(end_date)
 
+    dates, values = update_sp_bvl_levels(end_date)
+    start_ms = pd.Timestamp(start_date, tz="UTC").value // 10**6
+    end_ms = (pd.Timestamp(end_date, tz="UTC") + pd.Timedelta(days=1)).value
+    start_index, end_index = np.searchsorted(dates, [start_ms, end_ms // 10**6])
+    levels_df = pd.DataFrame(
+        {
+            "group": 0,
+            "x": dates[start_index:end_index],
+            "y": values[start_index:end_index],
+        }
+    )
+    df = format_grouped_values_per_month(levels_df, start_date, end_date)
+    df = df.drop(columns=["group"])
+    logging.debug(df)
+    logging.info("Got SP BVL General indexes")
+
+    return df
+
+
+def load_sp_bvl_levels():
+    try:
+        with np.load(SP_BVL_LEVELS_FILE) as store:
+            return store["dates"], store["values"], str(store["updated_on"])
+    except (OSError, KeyError, ValueError):
+        return np.empty(0, dtype=np.int64), np.empty(0), ""
+
+
+def save_sp_bvl_levels(dates: np.ndarray, values: np.ndarray, updated_on: str):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    file_descriptor, temp_file_name = tempfile.mkstemp(dir=CACHE_DIR)
+    with os.fdopen(file_descriptor, "wb") as store_file:
+        np.savez(store_file, dates=dates, values=values, updated_on=updated_on)
+    os.replace(temp_file_name, SP_BVL_LEVELS_FILE)
+
+
+def update_sp_bvl_levels(end_date: str):
+    # The daily levels are kept in a local store of epoch milliseconds and
+    # values. The endpoint only serves the whole history, so it is queried
+    # only when the store does not reach end_date and was not refreshed
+    # today, and then the levels served are merged into the store.
+    dates, values, updated_on = load_sp_bvl_levels()
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    if len(dates) > 0:
+        last_date = pd.to_datetime(dates[-1], unit="ms", utc=True)
+        if last_date.strftime("%Y-%m-%d") >= end_date or updated_on == today:
+            return dates, values
+
     url = URL_SP_BVL
     params = {
         "indexId": "92026288",
         "language_id": "2",
-        "_": end_date,
+        "_": today,
     }
     headers = {"User-Agent": USER_AGENT}
-    response = requests.get(url, params=params, headers=headers, verify=False)
-    jsonResponse = response.json()
-
-    df = format_values_per_month(
-        jsonResponse["indexLevelsHolder"]["indexLevels"],
-        start_date,
-        end_date,
-        "indexValue",
-        "effectiveDate",
+    response = http_get(url, params=params, headers=headers, verify=False)
+    levels = response.json()["indexLevelsHolder"]["indexLevels"]
+
+    stored_count = len(dates)
+    # Fetched levels go after the stored ones, so they win for the same date
+    dates = np.concatenate(
+        [
+            dates,
+            np.array(
+                [level["effectiveDate"] for level in levels], dtype=np.int64
+            ),
+        ]
     )
-    logging.debug(df)
-    logging.info("Got SP BVL General indexes")
+    values = np.concatenate(
+        [values, np.array([level["indexValue"] for level in levels], float)]
+    )
+    # The store is kept sorted by date without duplicates whatever the order
+    # of the levels served, as lookups rely on np.searchsorted.
+    order = np.argsort(dates, kind="stable")
+    dates, values = dates[order], values[order]
+    last_of_date = np.ones(len(dates), dtype=bool)
+    last_of_date[:-1] = dates[1:] != dates[:-1]
+    dates, values = dates[last_of_date], values[last_of_date]
+    logging.debug(f"New SP BVL levels: {len(dates) - stored_count}")
 
-    return df
+    save_sp_bvl_levels(dates, values, today)
+
+    return dates, values
 
 
 def get_raw_material_price(
@@ -379,18 +1120,31 @@ def get_raw_material_price(
         "cbCalculo": "NONE",
         "cbFechaBase": "",
     }
-    response = requests.get(URL_RAW_MATERIAL_PRICE, params=params)
-    soup = BeautifulSoup(response.text, "html.parser")
-    header = soup.select("thead > tr > .thData")
-    columns = [column.getText() for column in header]
-    rows = soup.select("#tbodyGrid > tr > td > .sname")
+    response = http_get(URL_RAW_MATERIAL_PRICE, params=params)
+
+    return parse_payload(
+        response.content,
+        parse_raw_material_table,
+        row_index,
+        source=response.url,
+    )
+
+
+def parse_raw_material_table(content: bytes, row_index: int) -> pd.DataFrame:
+    # A full parse is needed for the header, so it is done once in C by lxml
+    if not content.strip():
+        return pd.DataFrame({"Period": [], "Price": []}).set_index("Period")
+    tree = lxml.html.fromstring(content)
+    header = tree.cssselect("thead > tr > .thData")
+    columns = [column.text_content() for column in header]
+    rows = tree.cssselect("#tbodyGrid > tr > td > .sname")
     logging.debug(rows)
 
-    raw_material_values = soup.select(
+    raw_material_values = tree.cssselect(
         f"#tbodyGrid > tr:nth-of-type({row_index}) > .ar"
     )
     material_values = [
-        float(raw_value.getText().strip().replace(",", ""))
+        float(raw_value.text_content().strip().replace(",", ""))
         for raw_value in raw_material_values
     ]
 
@@ -465,74 +1219,44 @@ def get_euro_exchange_rate(start_date: str, end_date: str) -> pd.DataFrame:
 
 
 def get_dolar_exchange(year: int, month: str, currency_code: str, param: str):
-    headers = {"user-agent": USER_AGENT}
     url = f"{URL_DOLAR_EXCHANGE}?gcode=PAR_{currency_code}&param={param}"
 
-    with requests.Session() as s:
-        r = s.get(url, headers=headers)
-        soup = BeautifulSoup(r.content, "html.parser")
+    data = dict()
+    data["__EVENTTARGET"] = "DrDwnFechas"
+    data["DrDwnFechas"] = year
+    data["hdnFrecuencia"] = "DAILY"
 
-        data = dict()
-        data["__EVENTVALIDATION"] = soup.find(
-            "input", attrs={"id": "__EVENTVALIDATION"}
-        )["value"]
-        data["__VIEWSTATE"] = soup.find("input", attrs={"id": "__VIEWSTATE"})[
-            "value"
-        ]
-        data["__VIEWSTATEGENERATOR"] = soup.find(
-            "input", attrs={"id": "__VIEWSTATEGENERATOR"}
-        )["value"]
-        data["__EVENTTARGET"] = "DrDwnFechas"
-        data["DrDwnFechas"] = year
-        data["hdnFrecuencia"] = "DAILY"
-
-        p = s.post(url, data=data, headers=headers)
-        soup = BeautifulSoup(p.content, "html.parser")
-
-        MONTH_INDEX = {
-            "Enero": 1,
-            "Febrero": 2,
-            "Marzo": 3,
-            "Abril": 4,
-            "Mayo": 5,
-            "Junio": 6,
-            "Julio": 7,
-            "Agosto": 8,
-            "Septiembre": 9,
-            "Octubre": 10,
-            "Noviembre": 11,
-            "Diciembre": 12,
-        }
+    p = FORM_SESSIONS.post(url, data)
+    values_by_id = extract_dolar_exchange_values(p.content, month)
 
-        month_index = MONTH_INDEX[month]
-        next_year, next_month_index = get_next_year_month(year, month_index)
-            
-        days = pd.date_range(
-            f"{year}-{month_index:02d}-01",
-            f"{next_year}-{(next_month_index):02d}-01",
-            inclusive="left",
-        )
+    month_index = MONTH_INDEX[month]
+    next_year, next_month_index = get_next_year_month(year, month_index)
+
+    days = pd.date_range(
+        f"{year}-{month_index:02d}-01",
+        f"{next_year}-{(next_month_index):02d}-01",
+        inclusive="left",
+    )
 
-        values = []
-        for day in range(1, days.shape[0] + 1):
-            id = f"gr_ctl{(day + 1):02d}_{month}"
-            value_td = soup.find(id=id)
-            values.append(value_td.getText().strip())
+    values = []
+    for day in range(1, days.shape[0] + 1):
+        id = f"gr_ctl{(day + 1):02d}_{month}"
+        values.append(values_by_id[id])
 
-        logging.debug(values)
-        data = {"Day": days, "Value": values}
+    logging.debug(values)
+    data = {"Day": days, "Value": values}
 
-        df = pd.DataFrame(data)
-        df.replace("", np.nan, inplace=True)
-        df.dropna(inplace=True)
-        df["Value"] = df["Value"].str.replace(",", "")
-        df["Value"] = df["Value"].astype(float)
+    df = pd.DataFrame(data)
+    df.replace("", np.nan, inplace=True)
+    df.dropna(inplace=True)
+    df["Value"] = df["Value"].str.replace(",", "")
+    df["Value"] = df["Value"].astype(float)
 
-        df["Day"] = df["Day"].dt.strftime("%Y-%m-%d")
+    df["Day"] = df["Day"].dt.strftime("%Y-%m-%d")
 
-        df.set_index("Day", inplace=True)
-        
-        return df
+    df.set_index("Day", inplace=True)
+
+    return df
 
 
 def get_yen_dolar_exchange(year: int, month: str) -> pd.DataFrame:
@@ -588,26 +1312,16 @@ def get_expected_pbi(year: int) -> pd.DataFrame:
             "User-Agent": USER_AGENT,
             "Accept-Language": "es-ES,es;q=0.9,en;q=0.8",
         }
-        file_content = requests.get(
+        with stream_download(
             URL_EXPECTED_PBI, verify=False, headers=headers
-        ).content
-        # logging.debug(file_content)
-        df = pd.read_excel(
-            io.BytesIO(file_content), usecols="A:D", skiprows=3, sheet_name="PBI"
-        )
-        columns = df.columns
-        df["Expected Year"] = df["Fecha"]
-        condition = ~df["Expected Year"].str.contains("Expectativas", na=False)
-        df.loc[condition, "Expected Year"] = np.nan
-        df["Expected Year"] = df["Expected Year"].fillna(method="ffill")
-        df["Expected Year"] = df["Expected Year"].str.replace(
-            "Expectativas anuales de ", ""
-        )
-        df = df.loc[
-            (df["Expected Year"] == f"{year}")
-            | (df["Expected Year"] == f"{year + 1}"),
-            columns,
-        ]
+        ) as (expected_pbi_file, digest):
+            df = parse_payload(
+                expected_pbi_file,
+                parse_expected_pbi_workbook,
+                year,
+                source=URL_EXPECTED_PBI,
+                payload_digest=digest,
+            )
         logging.debug(df)
         logging.info("Got Expected PBI")
     except Exception as e:
@@ -617,6 +1331,25 @@ def get_expected_pbi(year: int) -> pd.DataFrame:
     return df
 
 
+def parse_expected_pbi_workbook(expected_pbi_file, year: int) -> pd.DataFrame:
+    df = pd.read_excel(
+        expected_pbi_file, usecols="A:D", skiprows=3, sheet_name="PBI"
+    )
+    columns = df.columns
+    df["Expected Year"] = df["Fecha"]
+    condition = ~df["Expected Year"].str.contains("Expectativas", na=False)
+    df.loc[condition, "Expected Year"] = np.nan
+    df["Expected Year"] = df["Expected Year"].fillna(method="ffill")
+    df["Expected Year"] = df["Expected Year"].str.replace(
+        "Expectativas anuales de ", ""
+    )
+    return df.loc[
+        (df["Expected Year"] == f"{year}")
+        | (df["Expected Year"] == f"{year + 1}"),
+        columns,
+    ]
+
+
 def get_monetary_policie_rate(start_date: str, end_date: str) -> pd.DataFrame:
     logging.info("Getting Monetary Policie Rate")
     logging.info("========================")
@@ -653,69 +1386,394 @@ def get_peruvian_goverment_bond(start_date: str, end_date: str) -> pd.DataFrame:
 def get_sbs_usd_exchange_rate(date: str) -> pd.DataFrame:
     logging.info("Getting SBS USD Exchange Rate")
     logging.info("========================")
-    headers = {"user-agent": USER_AGENT}
-
-    with requests.Session() as s:
-        r = s.get(URL_SBS_TC, headers=headers)
-        soup = BeautifulSoup(r.content, "html.parser")
-
-        data = dict()
-        data["__EVENTVALIDATION"] = soup.find(
-            "input", attrs={"id": "__EVENTVALIDATION"}
-        )["value"]
-        data["__VIEWSTATE"] = soup.find("input", attrs={"id": "__VIEWSTATE"})[
-            "value"
+
+    data = dict()
+    data["ctl00$MainScriptManager"] = (
+        "ctl00$cphContent$updConsulta|ctl00$cphContent$btnConsultar"
+    )
+    data["ctl00$cphContent$btnConsultar"] = "Consultar"
+
+    date_time = datetime.datetime.strptime(date, "%Y-%m-%d")
+    value = float(0)
+    for i in range(31):
+        date_time_str = date_time.strftime("%Y-%m-%d-%H-%M-%S")
+        date_str = date_time.strftime("%d/%m/%Y")
+        now_str = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+
+        data["ctl00$cphContent$rdpDate"] = date
+        data["ctl00$cphContent$rdpDate$dateInput"] = date_str
+        data["ctl00_cphContent_rdpDate_dateInput_ClientState"] = f"""
+            {{
+                "enabled": true,
+                "emptyMessage": "",
+                "validationText": "{date_time_str}",
+                "valueAsString": "{date_time_str}",
+                "minDateStr": "1000-01-01-00-00-00",
+                "maxDateStr": "{now_str}",
+                "lastSetTextBoxValue": "{date_str}"
+            }}
+            """
+
+        p = FORM_SESSIONS.post(URL_SBS_TC, data)
+        value_text = extract_sbs_exchange_rate(p.content)
+        if value_text:
+            value = float(value_text)
+            break
+
+        date_time -= datetime.timedelta(days=1)
+
+    logging.info("Got SBS USD Exchange Rate")
+    date_time_str = date_time.strftime("%Y-%m-%d")
+    df = pd.DataFrame(
+        {"Period": [date_time_str], "Value": [value]}
+    ).set_index("Period")
+    logging.debug(df)
+    return df
+
+
+KPI_MAP = {
+    1: {
+        "function": get_electricity,
+        "format": "%Y-%m",
+        "sheet_name_output": "Electricity (GWH)",
+    },
+    2: {
+        "function": get_vehicular_flow,
+        "sheet_name_output": "Vehicular Flow",
+    },
+    3: {
+        "function": get_dolar_exchange_rate,
+        "format": "%Y-%m-%d",
+        "sheet_name_output": "Dolar Exchange Rate",
+    },
+    4: {
+        "function": get_euro_exchange_rate,
+        "format": "%Y-%m-%d",
+        "sheet_name_output": "Euro Exchange Rate",
+    },
+    5: {
+        "function": get_yen_dolar_exchange,
+        "sheet_name_output": "Yen Dolar Exchange",
+    },
+    6: {
+        "function": get_brazilian_real_dolar_exchange,
+        "sheet_name_output": "Real Dolar Exchange",
+    },
+    9: {
+        "function": get_pbi,
+        "sheet_name_output": "PBI",
+    },
+    10: {
+        "function": get_expected_pbi,
+        "sheet_name_output": "Expected PBI",
+        "resample": False,
+    },
+    12: {
+        "function": get_intern_demand,
+        "sheet_name_output": "Intern Demand",
+    },
+    13: {
+        "function": get_unemployment_rate,
+        "format": "%Y-%m",
+        "sheet_name_output": "Unemployment Rate",
+    },
+    14: {
+        "function": get_monetary_policie_rate,
+        "format": "%Y-%m-%d",
+        "sheet_name_output": "Monetary Policy Rate",
+    },
+    15: {
+        "function": get_peruvian_goverment_bond,
+        "format": "%Y-%m",
+        "sheet_name_output": "10 Years Peruvian Goverment Bond",
+    },
+    16: {
+        "function": get_5years_treasury_bill_rate,
+        "format": "%Y-%m",
+        "sheet_name_output": "5 Years Treasure Bill Rate",
+    },
+    17: {
+        "function": get_10years_treasury_bill_rate,
+        "format": "%Y-%m",
+        "sheet_name_output": "10 Years Treasure Bill Rate",
+    },
+    18: {
+        "function": get_price_index,
+        "sheet_name_output": "Price Index",
+        # The index level, the other columns are its percentage changes
+        "value_column": "Índice",
+    },
+    20: {
+        "function": get_copper_price,
+        "sheet_name_output": "Copper Price",
+    },
+    21: {
+        "function": get_petroleum_wti_price,
+        "sheet_name_output": "Petroleum WTI Price",
+    },
+    23: {
+        "function": get_sp_bvl_general_index,
+        "format": "%Y-%m",
+        "sheet_name_output": "S&P BVL",
+    },
+    24: {
+        "function": get_djones_rate,
+        "format": "%Y-%m",
+        "sheet_name_output": "Djones Rate",
+    },
+    29: {
+        "function": get_sbs_usd_exchange_rate,
+        "format": "%Y-%m-%d",
+        "sheet_name_output": "SBS USD Exchange Rate",
+    },
+}
+
+
+DERIVED_OPERATIONS = {
+    "pct_change": lambda left, right, periods: (
+        (left / left.shift(periods) - 1) * 100
+    ),
+    "rolling_mean": lambda left, right, window: left.rolling(window).mean(),
+    "spread": lambda left, right, _: left - right,
+    "deflate": lambda left, right, _: left / right * 100,
+}
+
+# Derived KPIs are computed from the KPIs fetched for the same output
+# workbook. "kpi" and "other" are KPI_MAP numbers; a derived KPI whose
+# sources were not requested is skipped.
+DERIVED_KPI_MAP = {
+    "Electricity MoM (%)": {"operation": "pct_change", "kpi": 1, "periods": 1},
+    "Electricity YoY (%)": {"operation": "pct_change", "kpi": 1, "periods": 12},
+    "PBI MoM (%)": {"operation": "pct_change", "kpi": 9, "periods": 1},
+    "PBI YoY (%)": {"operation": "pct_change", "kpi": 9, "periods": 12},
+    "Unemployment Rate 3M Average": {
+        "operation": "rolling_mean",
+        "kpi": 13,
+        "window": 3,
+    },
+    "Copper Price 3M Average": {
+        "operation": "rolling_mean",
+        "kpi": 20,
+        "window": 3,
+    },
+    "Peruvian Bond - UST 10Y Spread": {
+        "operation": "spread",
+        "kpi": 15,
+        "other": 17,
+    },
+    "Real Dolar Exchange Rate": {
+        "operation": "deflate",
+        "kpi": 3,
+        "other": 18,
+    },
+}
+
+
+def parse_period_labels(labels) -> pd.DatetimeIndex:
+    labels = pd.Series(labels).astype(str).str.strip()
+    parts = pd.DataFrame(
+        np.nan, index=labels.index, columns=["year", "month", "day"]
+    )
+
+    for pattern in PERIOD_LABEL_PATTERNS:
+        pending = parts["year"].isna()
+        if not pending.any():
+            break
+
+        matches = labels[pending].str.extract(pattern)
+        matches = matches[matches["year"].notna()]
+        if matches.empty:
+            continue
+
+        year = matches["year"].astype(int)
+        year = year.where(year >= 100, year + 2000)
+        day = matches["day"] if "day" in matches else 1
+        if "month" in matches:
+            month = pd.to_numeric(matches["month"], errors="coerce")
+            month = month.fillna(
+                matches["month"].str.lower().map(MONTH_NUMBERS)
+            )
+        elif "quarter" in matches:
+            # Quarterly and annual values are anchored to the last day of
+            # their period, when they are known, not to its first month.
+            month = matches["quarter"].astype(int) * 3
+            day = month.map({3: 31, 6: 30, 9: 30, 12: 31})
+        else:
+            month = 12
+            day = 31
+
+        parts.loc[matches.index, "year"] = year
+        parts.loc[matches.index, "month"] = month
+        parts.loc[matches.index, "day"] = pd.to_numeric(day)
+
+    return pd.DatetimeIndex(pd.to_datetime(parts, errors="coerce"))
+
+
+def get_kpi_series(df: pd.DataFrame, value_column: str = None) -> pd.Series:
+    if "date" in df.columns:
+        df = df.set_index("date")
+    if {"Año", "Mes"}.issubset(df.columns):
+        year = df["Año"].astype(int).astype(str)
+        labels = year + "-" + df["Mes"].astype(str)
+        df = df.drop(columns=["Año", "Mes"]).set_index(labels)
+
+    values = df.apply(pd.to_numeric, errors="coerce")
+    if value_column is None:
+        value_column = values.notna().any().idxmax()
+    elif value_column not in values.columns:
+        # Headers may carry more than the declared name, like the base
+        # period of an index: "Índice" matches "Índice Dic.2021=100".
+        matches = [
+            column
+            for column in values.columns
+            if str(column).lower().startswith(value_column.lower())
         ]
-        data["__VIEWSTATEGENERATOR"] = soup.find(
-            "input", attrs={"id": "__VIEWSTATEGENERATOR"}
-        )["value"]
-        data["ctl00$MainScriptManager"] = (
-            "ctl00$cphContent$updConsulta|ctl00$cphContent$btnConsultar"
+        if not matches:
+            raise ValueError(f"No {value_column} column in {list(df.columns)}")
+        value_column = matches[0]
+
+    series = pd.Series(
+        values[value_column].to_numpy(), index=parse_period_labels(df.index)
+    )
+
+    return series[series.index.notna()].sort_index(kind="stable")
+
+
+def resample_series(
+    series: pd.Series, frequency: str = "M", aggregation: str = "last"
+) -> pd.Series:
+    periods = series.index.to_period(frequency)
+    if aggregation == "end":
+        # Value in force at the end of each period, carried forward through
+        # the periods without observations.
+        resampled = series.groupby(periods).last()
+        if resampled.empty:
+            return resampled
+        full_range = pd.period_range(
+            resampled.index.min(), periods.max(), freq=frequency
         )
-        data["ctl00$cphContent$btnConsultar"] = "Consultar"
-
-        date_time = datetime.datetime.strptime(date, "%Y-%m-%d")
-        value = float(0)
-        for i in range(31):
-            date_time_str = date_time.strftime("%Y-%m-%d-%H-%M-%S")
-            date_str = date_time.strftime("%d/%m/%Y")
-            now_str = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-
-            data["ctl00$cphContent$rdpDate"] = date
-            data["ctl00$cphContent$rdpDate$dateInput"] = date_str
-            data["ctl00_cphContent_rdpDate_dateInput_ClientState"] = f"""
-                {{
-                    "enabled": true,
-                    "emptyMessage": "",
-                    "validationText": "{date_time_str}",
-                    "valueAsString": "{date_time_str}",
-                    "minDateStr": "1000-01-01-00-00-00",
-                    "maxDateStr": "{now_str}",
-                    "lastSetTextBoxValue": "{date_str}"
-                }}
-                """
-
-            p = s.post(URL_SBS_TC, data=data, headers=headers)
-            soup = BeautifulSoup(p.content, "html.parser")
-            values = soup.select(
-                "#ctl00_cphContent_rgTipoCambio_ctl00__0 > td:nth-child(3)"
-            )
-            if len(values) > 0 and values[0].getText().strip() != "":
-                value = float(values[0].getText().strip())
-                break
+        return resampled.reindex(full_range).ffill()
 
-            date_time -= datetime.timedelta(days=1)
+    return series.groupby(periods).agg(aggregation)
 
-        logging.info("Got SBS USD Exchange Rate")
-        date_time_str = date_time.strftime("%Y-%m-%d")
-        df = pd.DataFrame(
-            {"Period": [date_time_str], "Value": [value]}
-        ).set_index("Period")
-        logging.debug(df)
-        return df
 
+def resample_kpi(
+    df: pd.DataFrame,
+    frequency: str,
+    aggregation: str = "last",
+    value_column: str = None,
+) -> pd.DataFrame:
+    series = get_kpi_series(df, value_column)
+    if series.empty or len(series) * 2 < len(df):
+        raise ValueError(
+            f"only {len(series)} of {len(df)} rows are labeled with a period"
+        )
+
+    series = resample_series(series, frequency, aggregation)
+    resampled_df = pd.DataFrame(
+        {"Value": series.to_numpy()},
+        index=series.index.strftime(FREQUENCY_FORMATS[frequency]),
+    )
+    resampled_df.index.name = "Period"
 
-def read_parameters(file_path: str, sheet_name: str):
+    return resampled_df
+
+
+def build_kpi_panel(
+    results: dict, derived_kpi_map: dict = DERIVED_KPI_MAP
+) -> pd.DataFrame:
+    # Only the sources of derived KPIs become columns. A KPI whose results
+    # are all empty, e.g. because its fetch failed, is left out and the
+    # derived KPIs depending on it are skipped.
+    sources = {
+        source
+        for spec in derived_kpi_map.values()
+        for source in (spec["kpi"], spec.get("other", spec["kpi"]))
+    }
+    columns = {}
+    for kpi_id, dfs in results.items():
+        if kpi_id not in sources:
+            continue
+
+        value_column = KPI_MAP[kpi_id].get("value_column")
+        try:
+            kpi_series = [
+                resample_series(get_kpi_series(df, value_column))
+                for df in dfs
+                if not df.empty
+            ]
+        except ValueError as e:
+            logging.warning(f"Leaving KPI {kpi_id} out of derived KPIs: {e}")
+            continue
+        if not kpi_series:
+            continue
+
+        series = pd.concat(kpi_series)
+        columns[kpi_id] = series[~series.index.duplicated(keep="last")]
+
+    panel = pd.DataFrame(columns).sort_index()
+    if panel.empty:
+        return panel
+
+    return panel.reindex(
+        pd.period_range(panel.index.min(), panel.index.max(), freq="M")
+    )
+
+
+def compute_derived_kpis(
+    panel: pd.DataFrame, derived_kpi_map: dict = DERIVED_KPI_MAP
+) -> pd.DataFrame:
+    # Derived KPIs sharing an operation and parameter are evaluated together
+    # as one column block, so adding one costs a column, not another pass.
+    groups = {}
+    names = []
+    for name, spec in derived_kpi_map.items():
+        sources = [spec["kpi"], spec.get("other", spec["kpi"])]
+        if not all(source in panel.columns for source in sources):
+            continue
+
+        names.append(name)
+        parameter = spec.get("periods", spec.get("window"))
+        groups.setdefault((spec["operation"], parameter), []).append(
+            (name, spec)
+        )
+
+    blocks = []
+    for (operation, parameter), specs in groups.items():
+        block_names = [name for name, _ in specs]
+        left = panel[[spec["kpi"] for _, spec in specs]].set_axis(
+            block_names, axis=1
+        )
+        right = panel[
+            [spec.get("other", spec["kpi"]) for _, spec in specs]
+        ].set_axis(block_names, axis=1)
+        blocks.append(DERIVED_OPERATIONS[operation](left, right, parameter))
+
+    if not blocks:
+        return pd.DataFrame()
+
+    derived_df = pd.concat(blocks, axis=1)[names].dropna(how="all")
+    derived_df.index = derived_df.index.strftime("%Y-%m")
+    derived_df.index.name = "Period"
+
+    return derived_df
+
+
+def get_derived_kpis(output_path: str, results: dict):
+    try:
+        derived_df = compute_derived_kpis(build_kpi_panel(results))
+    except Exception as e:
+        logging.error(f"Error computing derived KPIs for {output_path}: {e}")
+        return None
+
+    if derived_df.empty:
+        return None
+
+    logging.debug(derived_df)
+    return derived_df
+
+
+def read_parameters(file_path: str, sheet_name: str) -> pd.DataFrame:
     parameters_df = pd.read_excel(
         file_path,
         sheet_name=sheet_name,
@@ -723,104 +1781,10 @@ def read_parameters(file_path: str, sheet_name: str):
         usecols=["N°", "Titulo KPI", "Inicio", "Fin"],
     )
 
-    kpi_map = {
-        1: {
-            "function": get_electricity,
-            "format": "%Y-%m",
-            "sheet_name_output": "Electricity (GWH)",
-        },
-        2: {
-            "function": get_vehicular_flow,
-            "sheet_name_output": "Vehicular Flow",
-        },
-        3: {
-            "function": get_dolar_exchange_rate,
-            "format": "%Y-%m-%d",
-            "sheet_name_output": "Dolar Exchange Rate",
-        },
-        4: {
-            "function": get_euro_exchange_rate,
-            "format": "%Y-%m-%d",
-            "sheet_name_output": "Euro Exchange Rate",
-        },
-        5: {
-            "function": get_yen_dolar_exchange,
-            "sheet_name_output": "Yen Dolar Exchange",
-        },
-        6: {
-            "function": get_brazilian_real_dolar_exchange,
-            "sheet_name_output": "Real Dolar Exchange",
-        },
-        9: {
-            "function": get_pbi,
-            "sheet_name_output": "PBI",
-        },
-        10: {
-            "function": get_expected_pbi,
-            "sheet_name_output": "Expected PBI",
-        },
-        12: {
-            "function": get_intern_demand,
-            "sheet_name_output": "Intern Demand",
-        },
-        13: {
-            "function": get_unemployment_rate,
-            "format": "%Y-%m",
-            "sheet_name_output": "Unemployment Rate",
-        },
-        14: {
-            "function": get_monetary_policie_rate,
-            "format": "%Y-%m-%d",
-            "sheet_name_output": "Monetary Policy Rate",
-        },
-        15: {
-            "function": get_peruvian_goverment_bond,
-            "format": "%Y-%m",
-            "sheet_name_output": "10 Years Peruvian Goverment Bond",
-        },
-        16: {
-            "function": get_5years_treasury_bill_rate,
-            "format": "%Y-%m",
-            "sheet_name_output": "5 Years Treasure Bill Rate",
-        },
-        17: {
-            "function": get_10years_treasury_bill_rate,
-            "format": "%Y-%m",
-            "sheet_name_output": "10 Years Treasure Bill Rate",
-        },
-        18: {
-            "function": get_price_index,
-            "sheet_name_output": "Price Index",
-        },
-        20: {
-            "function": get_copper_price,
-            "sheet_name_output": "Copper Price",
-        },
-        21: {
-            "function": get_petroleum_wti_price,
-            "sheet_name_output": "Petroleum WTI Price",
-        },
-        23: {
-            "function": get_sp_bvl_general_index,
-            "format": "%Y-%m",
-            "sheet_name_output": "S&P BVL",
-        },
-        24: {
-            "function": get_djones_rate,
-            "format": "%Y-%m",
-            "sheet_name_output": "Djones Rate",
-        },
-        29: {
-            "function": get_sbs_usd_exchange_rate,
-            "format": "%Y-%m-%d",
-            "sheet_name_output": "SBS USD Exchange Rate",
-        },
-    }
-
-    parameters_df = parameters_df[parameters_df["N°"].isin(kpi_map.keys())]
+    parameters_df = parameters_df[parameters_df["N°"].isin(KPI_MAP.keys())]
 
     def transform(row):
-        format = kpi_map[row["N°"]].get("format")
+        format = KPI_MAP[row["N°"]].get("format")
         if format:
             row["Inicio"] = row["Inicio"].strftime(format)
             if not pd.isna(row["Fin"]):
@@ -828,35 +1792,503 @@ def read_parameters(file_path: str, sheet_name: str):
 
         return row
 
-    def execute(row):
-        function = kpi_map.get(row["N°"], {}).get("function")
-        sheet_name = kpi_map.get(row["N°"], {}).get("sheet_name_output")
-        if function:
-            try:
-                logging.debug(row["Fin"])
-                if not pd.isna(row["Fin"]):
-                    df = function(row["Inicio"], row["Fin"])
-                else:
-                    df = function(row["Inicio"])
-            except Exception as e:
-                logging.error(f"Error executing function {function}: {e}")
-            try:
-                with pd.ExcelWriter(
-                    "output.xlsx", mode="a", engine='openpyxl', if_sheet_exists="replace"
-                ) as writer:
-                    df.to_excel(writer, sheet_name=sheet_name)
-            except Exception as e:
-                logging.error(f"Error wrting to sheet_name: {sheet_name}: {e}")
-                with pd.ExcelWriter("output.xlsx", mode="w") as writer:
-                    df.to_excel(writer, sheet_name=sheet_name)
-
     parameters_df = parameters_df.apply(lambda row: transform(row), axis=1)
-    parameters_df.apply(lambda row: execute(row), axis=1)
     logging.debug(parameters_df)
 
+    return parameters_df
+
+
+def get_fetch_key(row) -> tuple:
+    end = None if pd.isna(row["Fin"]) else row["Fin"]
+    return int(row["N°"]), row["Inicio"], end
 
-def main():
-    read_parameters("input.xlsx", "Parametros")
+
+def build_fetch_plan(jobs: list, sheet_name: str = PARAMETERS_SHEET_NAME):
+    # Rows asking for the same KPI and window in several workbooks collapse
+    # into one key, so every source is queried once per run and the result
+    # is fanned out to each (output_path, sheet_name) target.
+    plan = {}
+    for input_path, output_path in jobs:
+        try:
+            parameters_df = read_parameters(input_path, sheet_name)
+        except Exception as e:
+            logging.error(f"Error reading parameters from {input_path}: {e}")
+            continue
+
+        for _, row in parameters_df.iterrows():
+            key = get_fetch_key(row)
+            sheet_name_output = KPI_MAP[key[0]]["sheet_name_output"]
+            targets = plan.setdefault(key, [])
+            if (output_path, sheet_name_output) not in targets:
+                targets.append((output_path, sheet_name_output))
+
+    return plan
+
+
+def fetch_kpi(key: tuple):
+    kpi_id, start, end = key
+    function = KPI_MAP[kpi_id]["function"]
+    try:
+        logging.debug(end)
+        if end is not None:
+            return function(start, end)
+        return function(start)
+    except Exception as e:
+        logging.error(f"Error executing function {function}: {e}")
+        return None
+
+
+def get_profile_stem(key: tuple) -> str:
+    kpi_id, start, end = key
+    name = f"{kpi_id:02d}_{KPI_MAP[kpi_id]['sheet_name_output']}_{start}"
+    if end is not None:
+        name = f"{name}_{end}"
+    return re.sub(r"[^0-9A-Za-z]+", "_", name).strip("_")
+
+
+def get_frame_label(function: tuple) -> str:
+    file_name, line, name = function
+    if file_name == "~":
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(file_name)}:{line})"
+    return label.replace(";", ",")
+
+
+def write_folded_stacks(stats: pstats.Stats, file_path: str):
+    # Rebuilds call stacks from cProfile caller edges in the "frame;frame
+    # microseconds" format read by flamegraph.pl and speedscope. A callee
+    # reached from several callers has its time split by each edge's share.
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[function] = edge
+
+    roots = [
+        function
+        for function, (_, _, _, _, callers) in stats.stats.items()
+        if not any(caller in stats.stats for caller in callers)
+    ]
+
+    folded = {}
+
+    def visit(function, stack, path, share):
+        _, _, total_time, _, _ = stats.stats[function]
+        stack = f"{stack};{get_frame_label(function)}".lstrip(";")
+        self_us = total_time * share * 1e6
+        if self_us >= FOLDED_STACK_MIN_US:
+            folded[stack] = folded.get(stack, 0) + self_us
+
+        if len(path) >= FOLDED_STACK_MAX_DEPTH:
+            return
+
+        for callee, (_, _, _, edge_time) in callees.get(function, {}).items():
+            callee_time = stats.stats[callee][3]
+            if callee in path or not callee_time:
+                continue
+
+            callee_share = share * edge_time / callee_time
+            if callee_share * callee_time * 1e6 < FOLDED_STACK_MIN_US:
+                continue
+
+            visit(callee, stack, path | {callee}, callee_share)
+
+    for root in roots:
+        visit(root, "", {root}, 1.0)
+
+    with open(file_path, "w") as folded_file:
+        for stack, value in folded.items():
+            folded_file.write(f"{stack} {round(value)}\n")
+
+
+def profile_kpi(key: tuple, profile_dir: str, profile_rows: list):
+    stem = os.path.join(profile_dir, get_profile_stem(key))
+    profiler = cProfile.Profile()
+
+    PROFILING.set()
+    tracemalloc.start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    profiler.enable()
+    try:
+        df = fetch_kpi(key)
+    finally:
+        profiler.disable()
+        PROFILING.clear()
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        net_memory, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    profiler.dump_stats(f"{stem}.prof")
+    write_folded_stacks(pstats.Stats(profiler), f"{stem}.folded")
+
+    kpi_id, start, end = key
+    profile_rows.append(
+        {
+            "N°": kpi_id,
+            "KPI": KPI_MAP[kpi_id]["sheet_name_output"],
+            "Inicio": start,
+            "Fin": end,
+            "CPU (s)": cpu_time,
+            "Wall (s)": wall_time,
+            "Peak Memory (MB)": peak_memory / 2**20,
+            "Net Memory (MB)": net_memory / 2**20,
+            "Profile": f"{stem}.prof",
+        }
+    )
+
+    return df
+
+
+def write_profile_summary(profile_rows: list, profile_dir: str):
+    if not profile_rows:
+        return
+
+    summary_df = pd.DataFrame(profile_rows)
+    for column, rank_column in [
+        ("CPU (s)", "CPU Rank"),
+        ("Wall (s)", "Wall Rank"),
+        ("Peak Memory (MB)", "Memory Rank"),
+    ]:
+        summary_df[rank_column] = (
+            summary_df[column].rank(ascending=False, method="min").astype(int)
+        )
+    summary_df = summary_df.sort_values("CPU (s)", ascending=False)
+
+    summary_path = os.path.join(profile_dir, "summary.csv")
+    summary_df.to_csv(summary_path, index=False)
+    logging.info(
+        "Profile summary\n"
+        + summary_df.drop(columns=["Profile"]).to_string(
+            index=False, float_format="{:.3f}".format
+        )
+    )
+    logging.info(f"Profiles written to {profile_dir}")
+
+
+def resample_fetched_kpi(
+    key: tuple, df: pd.DataFrame, frequency: str, aggregation: str
+) -> pd.DataFrame:
+    # KPIs that are not time series, like the expectations surveyed for
+    # each year, keep their own layout.
+    if not KPI_MAP[key[0]].get("resample", True):
+        return df
+
+    value_column = KPI_MAP[key[0]].get("value_column")
+    try:
+        return resample_kpi(df, frequency, aggregation, value_column)
+    except Exception as e:
+        logging.warning(f"Keeping KPI {key[0]} at its own frequency: {e}")
+        return df
+
+
+def write_sheet(output_path: str, sheet_name: str, df: pd.DataFrame) -> bool:
+    # Returns whether the workbook was written from scratch, leaving only
+    # this sheet in it.
+    if not os.path.exists(output_path):
+        with pd.ExcelWriter(output_path, mode="w") as writer:
+            df.to_excel(writer, sheet_name=sheet_name)
+        return True
+
+    try:
+        with pd.ExcelWriter(
+            output_path,
+            mode="a",
+            engine="openpyxl",
+            if_sheet_exists="replace",
+        ) as writer:
+            df.to_excel(writer, sheet_name=sheet_name)
+    except Exception as e:
+        logging.error(f"Error wrting to sheet_name: {sheet_name}: {e}")
+        with pd.ExcelWriter(output_path, mode="w") as writer:
+            df.to_excel(writer, sheet_name=sheet_name)
+        return True
+
+    return False
+
+
+def load_state() -> dict:
+    try:
+        with open(STATE_FILE) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {"sheets": {}}
+
+
+def save_state(state: dict):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(STATE_FILE, "w") as state_file:
+        json.dump(state, state_file, indent=2)
+
+
+def get_result_digest(df: pd.DataFrame) -> str:
+    content = df.to_json(orient="split", date_format="iso", default_handler=str)
+    return get_payload_digest(content.encode())
+
+
+def get_sheet_names(output_path: str) -> set:
+    if not os.path.exists(output_path):
+        return set()
+    try:
+        with pd.ExcelFile(output_path) as workbook:
+            return set(workbook.sheet_names)
+    except Exception as e:
+        logging.warning(f"Error reading sheets of {output_path}: {e}")
+        return set()
+
+
+def publish_sheet(
+    output_path: str,
+    sheet_name: str,
+    df: pd.DataFrame,
+    state: dict,
+    sheet_names: dict,
+    force: bool = False,
+) -> bool:
+    # Sheets whose content hashes the same as in the last run and that are
+    # still present in the workbook are not written again.
+    digest = get_result_digest(df)
+    digests = state["sheets"].setdefault(os.path.abspath(output_path), {})
+    if output_path not in sheet_names:
+        sheet_names[output_path] = get_sheet_names(output_path)
+
+    if (
+        not force
+        and digests.get(sheet_name) == digest
+        and sheet_name in sheet_names[output_path]
+    ):
+        return False
+
+    if write_sheet(output_path, sheet_name, df):
+        # The other sheets are gone, they are written again when published
+        sheet_names[output_path] = set()
+    sheet_names[output_path].add(sheet_name)
+    digests[sheet_name] = digest
+    return True
+
+
+def log_run_report(changed: list, unchanged: list):
+    logging.info(
+        f"Run report: {len(changed)} sheets changed, {len(unchanged)}"
+        f" unchanged, {RUN_STATS['parsed']} payloads parsed,"
+        f" {RUN_STATS['parse_skipped']} unchanged payloads not parsed again,"
+        f" {RUN_STATS['requests_shared']} in-flight requests shared,"
+        f" {RUN_STATS['parses_shared']} parses shared,"
+        f" {RUN_STATS['primes_shared']} form session primings shared"
+    )
+    for output_path, sheet_name in changed:
+        logging.info(f"Changed: {output_path} -> {sheet_name}")
+
+
+def run_batch(
+    jobs: list,
+    sheet_name: str = PARAMETERS_SHEET_NAME,
+    frequency: str = None,
+    aggregation: str = "last",
+    profile_dir: str = None,
+    force: bool = False,
+    workers: int = 1,
+):
+    RUN_STATS.clear()
+    PARSED_CACHE_USED.clear()
+    state = load_state()
+    sheet_names = {}
+    changed = []
+    unchanged = []
+
+    plan = build_fetch_plan(jobs, sheet_name)
+    plan_ml_instruments(plan)
+    targets_count = sum(len(targets) for targets in plan.values())
+    logging.info(
+        f"Fetch plan: {len(plan)} unique requests for {targets_count} sheets"
+        f" across {len(jobs)} workbooks"
+    )
+
+    profile_rows = []
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    # The fetches run concurrently, identical requests of different KPIs
+    # that are in flight at the same time share one download. Sheets are
+    # still written one at a time in plan order. cProfile and tracemalloc
+    # measure the whole process, so profiled fetches run one at a time.
+    if profile_dir:
+        fetched = [profile_kpi(key, profile_dir, profile_rows) for key in plan]
+    else:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            fetched = list(executor.map(fetch_kpi, plan))
+
+    output_results = {}
+    for (key, targets), df in zip(plan.items(), fetched):
+        if df is None:
+            continue
+
+        # Derived KPIs are computed from the KPI at its own frequency, only
+        # the KPI sheet is resampled.
+        sheet_df = df
+        if frequency:
+            sheet_df = resample_fetched_kpi(key, df, frequency, aggregation)
+
+        for output_path, sheet_name_output in targets:
+            results = output_results.setdefault(output_path, {})
+            results.setdefault(key[0], []).append(df)
+            if publish_sheet(
+                output_path,
+                sheet_name_output,
+                sheet_df,
+                state,
+                sheet_names,
+                force,
+            ):
+                changed.append((output_path, sheet_name_output))
+            else:
+                unchanged.append((output_path, sheet_name_output))
+
+    for output_path, results in output_results.items():
+        derived_df = get_derived_kpis(output_path, results)
+        if derived_df is None:
+            continue
+
+        if publish_sheet(
+            output_path,
+            DERIVED_SHEET_NAME,
+            derived_df,
+            state,
+            sheet_names,
+            force,
+        ):
+            changed.append((output_path, DERIVED_SHEET_NAME))
+        else:
+            unchanged.append((output_path, DERIVED_SHEET_NAME))
+
+    save_state(state)
+    prune_parsed_cache()
+    write_profile_summary(profile_rows, profile_dir)
+    log_run_report(changed, unchanged)
+
+
+def get_jobs(
+    inputs: list, outputs: list, patterns: list, output_dir: str
+) -> list:
+    if len(outputs) > len(inputs):
+        raise ValueError("There are more --output than --input workbooks")
+
+    jobs = []
+    for index, input_path in enumerate(inputs):
+        if index < len(outputs):
+            jobs.append((input_path, outputs[index]))
+        else:
+            jobs.append((input_path, get_output_path(input_path, output_dir)))
+
+    # Workbooks written by this or an earlier run usually match the same
+    # globs as the inputs, they are not taken as inputs.
+    output_paths = {os.path.abspath(output_path) for _, output_path in jobs}
+    for pattern in patterns:
+        for input_path in sorted(glob.glob(pattern)):
+            if (
+                input_path.endswith(OUTPUT_SUFFIX)
+                or os.path.abspath(input_path) in output_paths
+            ):
+                continue
+            output_path = get_output_path(input_path, output_dir)
+            jobs.append((input_path, output_path))
+            output_paths.add(os.path.abspath(output_path))
+
+    if not jobs:
+        jobs.append(("input.xlsx", "output.xlsx"))
+
+    return jobs
+
+
+def get_output_path(input_path: str, output_dir: str) -> str:
+    file_name = os.path.basename(input_path)
+    stem, _ = os.path.splitext(file_name)
+    return os.path.join(output_dir, f"{stem}{OUTPUT_SUFFIX}")
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Get KPIs from web pages")
+    parser.add_argument(
+        "-i",
+        "--input",
+        action="append",
+        default=[],
+        help="Parameters workbook, can be repeated",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="append",
+        default=[],
+        help="Output workbook for the --input in the same position",
+    )
+    parser.add_argument(
+        "-g",
+        "--glob",
+        action="append",
+        default=[],
+        help="Glob pattern of parameters workbooks, can be repeated",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=".",
+        help="Folder for the outputs of inputs without an explicit --output",
+    )
+    parser.add_argument(
+        "--sheet",
+        default=PARAMETERS_SHEET_NAME,
+        help="Sheet name holding the parameters in every input workbook",
+    )
+    parser.add_argument(
+        "--frequency",
+        choices=FREQUENCY_FORMATS.keys(),
+        help="Resample every KPI to this frequency before writing it",
+    )
+    parser.add_argument(
+        "--aggregation",
+        choices=AGGREGATIONS,
+        default="last",
+        help="How values are reduced into each period when resampling",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Write every sheet even if its content did not change",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile CPU and memory of every KPI fetch",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default="profiles",
+        help="Folder for the per KPI profiles and the summary table",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of KPIs fetched at the same time",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    jobs = get_jobs(args.input, args.output, args.glob, args.output_dir)
+    if args.output_dir != ".":
+        os.makedirs(args.output_dir, exist_ok=True)
+    run_batch(
+        jobs,
+        args.sheet,
+        args.frequency,
+        args.aggregation,
+        args.profile_dir if args.profile else None,
+        args.force,
+        args.workers,
+    )
     # # KPI 1
     # get_electricity("2023-04", "2023-06")
     # # KPI 2
@@ -0,0 +1,403 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+import app
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Recorded pages live in one folder, one file per page. Pages that are the
+# answer of an ASP.NET POST (bcentral.cl exchange tables and SBS rates) can
+# not be recorded with a GET, save them from the browser with these names,
+# or use --generate to write synthetic pages of the same shape.
+PAGES_DIR = "recorded_pages"
+DOLAR_EXCHANGE_MONTH = "Julio"
+RAW_MATERIAL_ROW_INDEX = 4
+GENERATED_PAGE_KB = 800
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+MONTHS = list(app.MONTH_INDEX)
+
+
+def soup_form_tokens(content: bytes) -> dict:
+    soup = BeautifulSoup(content, "html.parser")
+    return {
+        field: soup.find("input", attrs={"id": field})["value"]
+        for field in app.ASPNET_HIDDEN_FIELDS
+    }
+
+
+def soup_vehicular_flow_path(content: bytes) -> str:
+    soup = BeautifulSoup(content, "html.parser")
+    return soup.find(id="row_1").get("rel")
+
+
+def soup_pbi_data_url(content: bytes) -> str:
+    soup = BeautifulSoup(content, "html.parser")
+    return soup.select(
+        "#download-resumen_5-mensual-report > .js-btn-download-report"
+    )[0].get("data-url")
+
+
+def soup_price_index_path(content: bytes) -> str:
+    soup = BeautifulSoup(content, "html.parser")
+    return soup.select("a[title='IPC Nacional']")[0].get("href")
+
+
+def soup_raw_material_table(content: bytes) -> list:
+    soup = BeautifulSoup(content, "html.parser")
+    header = soup.select("thead > tr > .thData")
+    values = soup.select(
+        f"#tbodyGrid > tr:nth-of-type({RAW_MATERIAL_ROW_INDEX}) > .ar"
+    )
+    return [column.getText() for column in header][2:] + [
+        float(value.getText().strip().replace(",", "")) for value in values
+    ]
+
+
+def fast_raw_material_table(content: bytes) -> list:
+    df = app.parse_raw_material_table(content, RAW_MATERIAL_ROW_INDEX)
+    return list(df.index) + list(df["Price"])
+
+
+def soup_dolar_exchange_values(content: bytes) -> dict:
+    soup = BeautifulSoup(content, "html.parser")
+    return {
+        element.get("id"): element.getText().strip()
+        for element in soup.find_all(id=True)
+        if element.get("id").startswith("gr_ctl")
+        and element.get("id").endswith(f"_{DOLAR_EXCHANGE_MONTH}")
+    }
+
+
+def soup_sbs_exchange_rate(content: bytes) -> str:
+    soup = BeautifulSoup(content, "html.parser")
+    values = soup.select(
+        "#ctl00_cphContent_rgTipoCambio_ctl00__0 > td:nth-child(3)"
+    )
+    return values[0].getText().strip() if values else ""
+
+
+def filler_html(size: int) -> str:
+    # Markup shaped like the navigation and news blocks around the nodes the
+    # scrapers look for, repeated up to about size bytes.
+    block = (
+        '<div class="card"><a href="/noticias/{0}" class="link">Nota {0}</a>'
+        '<p class="summary">Lorem ipsum dolor sit amet, consectetur'
+        " adipiscing elit, sed do eiusmod tempor incididunt.</p>"
+        '<ul><li><span class="tag">INEI</span></li><li>2023</li></ul></div>'
+    )
+    blocks = []
+    length = 0
+    while length < size:
+        blocks.append(block.format(len(blocks)))
+        length += len(blocks[-1])
+    return "".join(blocks)
+
+
+def wrap_html(body: str, size: int) -> str:
+    # The nodes are placed after half of the filler, so an early exit still
+    # parses a good part of the page.
+    half = filler_html(size // 2)
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>KPIs</title>'
+        f"</head><body>{half}{body}{half}</body></html>"
+    )
+
+
+def generate_vehicular_flow(size: int) -> str:
+    rows = "".join(
+        f'<tr id="row_{row}" rel="/media/flujo-vehicular/{row}.pdf">'
+        f"<td>Boletin {row}</td></tr>"
+        for row in range(1, 13)
+    )
+    return wrap_html(f"<table><tbody>{rows}</tbody></table>", size)
+
+
+def generate_pbi(size: int) -> str:
+    return wrap_html(
+        '<div id="download-resumen_5-mensual-report">'
+        '<a class="btn js-btn-download-report"'
+        ' data-url=\'{"excel": "/media/principales_indicadores/pbi.zip"}\'>'
+        "Descargar</a></div>",
+        size,
+    )
+
+
+def generate_price_index(size: int) -> str:
+    links = "".join(
+        f'<a title="IPC {city}" href="/media/ipc-{city}.xlsx">{city}</a>'
+        for city in ["Lima", "Arequipa", "Cusco"]
+    )
+    return wrap_html(
+        f'{links}<a title="IPC Nacional" href="/media/ipc-nacional.xlsx">'
+        "Nacional</a>",
+        size,
+    )
+
+
+def generate_raw_material(size: int) -> str:
+    months = [f"{month}.2023" for month in MONTHS]
+    header = "".join(
+        f'<th class="thData">{label}</th>'
+        for label in ["Producto", "Unidad"] + months
+    )
+    rows = "".join(
+        f'<tr><td><span class="sname">Producto {row}</span></td><td>US$</td>'
+        + "".join(
+            f'<td class="ar"> {row * 1000 + column},{column:02d}0.5 </td>'
+            for column in range(len(months))
+        )
+        + "</tr>"
+        for row in range(1, 41)
+    )
+    return wrap_html(
+        f'<table><thead><tr>{header}</tr></thead><tbody id="tbodyGrid">'
+        f"{rows}</tbody></table>",
+        size,
+    )
+
+
+def generate_sbs_form(size: int) -> str:
+    inputs = "".join(
+        f'<input type="hidden" id="{field}" name="{field}"'
+        f' value="{field[2:].upper() * 40}" />'
+        for field in app.ASPNET_HIDDEN_FIELDS
+    )
+    return wrap_html(f'<form method="post">{inputs}</form>', size)
+
+
+def generate_dolar_exchange(size: int) -> str:
+    rows = "".join(
+        "<tr>"
+        + "".join(
+            f'<td><span id="gr_ctl{row:02d}_{month}">'
+            f" {row + index / 100:.2f} </span></td>"
+            for index, month in enumerate(MONTHS)
+        )
+        + "</tr>"
+        for row in range(2, 33)
+    )
+    return wrap_html(f"<table>{rows}</table>", size)
+
+
+def generate_sbs_exchange_rate(size: int) -> str:
+    rows = "".join(
+        f'<tr id="ctl00_cphContent_rgTipoCambio_ctl00__{row}">'
+        f"<td>{currency}</td><td>3.{row}01</td><td> 3.{row}05 </td></tr>"
+        for row, currency in enumerate(["Dolar", "Euro", "Yen"])
+    )
+    # The real page is small, only the rates table after the form
+    return wrap_html(f"<table><tbody>{rows}</tbody></table>", size // 40)
+
+
+PAGES = {
+    "vehicular_flow.html": {
+        "generate": generate_vehicular_flow,
+        "url": f"{app.URL_BASE_TOLL}/2023/1",
+        "soup": soup_vehicular_flow_path,
+        "fast": app.extract_vehicular_flow_path,
+    },
+    "pbi.html": {
+        "generate": generate_pbi,
+        "url": app.URL_INEI_PBI,
+        "soup": soup_pbi_data_url,
+        "fast": app.extract_pbi_data_url,
+    },
+    "price_index.html": {
+        "generate": generate_price_index,
+        "url": app.URL_INEI_PRICE_INDEX,
+        "soup": soup_price_index_path,
+        "fast": app.extract_price_index_path,
+    },
+    "raw_material.html": {
+        "generate": generate_raw_material,
+        "url": app.URL_RAW_MATERIAL_PRICE,
+        "soup": soup_raw_material_table,
+        "fast": fast_raw_material_table,
+    },
+    "sbs_form.html": {
+        "generate": generate_sbs_form,
+        "url": app.URL_SBS_TC,
+        "soup": soup_form_tokens,
+        "fast": app.extract_form_tokens,
+    },
+    "dolar_exchange.html": {
+        "generate": generate_dolar_exchange,
+        "soup": soup_dolar_exchange_values,
+        "fast": lambda content: app.extract_dolar_exchange_values(
+            content, DOLAR_EXCHANGE_MONTH
+        ),
+    },
+    "sbs_exchange_rate.html": {
+        "generate": generate_sbs_exchange_rate,
+        "soup": soup_sbs_exchange_rate,
+        "fast": app.extract_sbs_exchange_rate,
+    },
+}
+
+
+def record_pages(pages_dir: str):
+    os.makedirs(pages_dir, exist_ok=True)
+    for file_name, page in PAGES.items():
+        if "url" not in page:
+            continue
+
+        try:
+            response = app.SESSION.get(page["url"], verify=False)
+        except Exception as e:
+            logging.error(f"Error recording {file_name}: {e}")
+            continue
+
+        with open(os.path.join(pages_dir, file_name), "wb") as page_file:
+            page_file.write(response.content)
+        logging.info(f"Recorded {file_name}: {len(response.content)} bytes")
+
+
+def generate_pages(pages_dir: str, size: int):
+    os.makedirs(pages_dir, exist_ok=True)
+    for file_name, page in PAGES.items():
+        with open(os.path.join(pages_dir, file_name), "w") as page_file:
+            page_file.write(page["generate"](size))
+        logging.info(f"Generated {file_name}")
+
+
+def measure(extract, content: bytes, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = extract(content)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    extract(content)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, statistics.median(timings), peak_memory
+
+
+def reset_peak_rss():
+    # Linux resets the peak RSS to the current one, otherwise the peak left
+    # by the imports of the process can hide the one of the extraction.
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss() -> int:
+    # In bytes. ru_maxrss of a spawned process also counts the memory of the
+    # process it was forked from, VmHWM on Linux only counts its own.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+def measure_rss(page_path: str, file_name: str, variant: str) -> float:
+    # Runs in a fresh process, so the growth of its peak RSS is due to this
+    # extraction only. Unlike tracemalloc it includes the buffers libxml2
+    # allocates in C.
+    with open(page_path, "rb") as page_file:
+        content = page_file.read()
+    extract = PAGES[file_name][variant]
+
+    reset_peak_rss()
+    peak_before = get_peak_rss()
+    extract(content)
+    peak_after = get_peak_rss()
+
+    return (peak_after - peak_before) / 2**20
+
+
+def measure_rss_isolated(page_path: str, file_name: str, variant: str):
+    if resource is None:
+        return float("nan")
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(measure_rss, (page_path, file_name, variant))
+
+
+def benchmark_pages(pages_dir: str, repeat: int):
+    print(
+        f"{'Page':<24}{'KB':>8}{'Soup ms':>10}{'Fast ms':>10}{'Speedup':>9}"
+        f"{'Soup MB':>9}{'Fast MB':>9}{'Soup RSS':>10}{'Fast RSS':>10}  Same"
+    )
+    # MB columns are the peak of Python allocations seen by tracemalloc, the
+    # RSS columns the growth of the peak resident memory of the process.
+    for file_name, page in PAGES.items():
+        page_path = os.path.join(pages_dir, file_name)
+        if not os.path.exists(page_path):
+            continue
+
+        with open(page_path, "rb") as page_file:
+            content = page_file.read()
+
+        soup_result, soup_time, soup_memory = measure(
+            page["soup"], content, repeat
+        )
+        fast_result, fast_time, fast_memory = measure(
+            page["fast"], content, repeat
+        )
+        soup_rss = measure_rss_isolated(page_path, file_name, "soup")
+        fast_rss = measure_rss_isolated(page_path, file_name, "fast")
+        print(
+            f"{file_name:<24}{len(content) / 1024:>8.0f}"
+            f"{soup_time * 1000:>10.2f}{fast_time * 1000:>10.2f}"
+            f"{soup_time / fast_time:>8.1f}x"
+            f"{soup_memory / 2**20:>9.2f}{fast_memory / 2**20:>9.2f}"
+            f"{soup_rss:>10.2f}{fast_rss:>10.2f}"
+            f"  {soup_result == fast_result}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare BeautifulSoup and lxml extraction per scraper"
+    )
+    parser.add_argument("--pages-dir", default=PAGES_DIR)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="Download the GET pages into --pages-dir before benchmarking",
+    )
+    parser.add_argument(
+        "--generate",
+        action="store_true",
+        help="Write synthetic pages into --pages-dir before benchmarking",
+    )
+    parser.add_argument(
+        "--page-kb",
+        type=int,
+        default=GENERATED_PAGE_KB,
+        help="Approximate size of the generated pages",
+    )
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_pages(args.pages_dir, args.page_kb * 1024)
+    if args.record:
+        record_pages(args.pages_dir)
+    benchmark_pages(args.pages_dir, args.repeat)
+
+
+if __name__ == "__main__":
+    main()